@@ -20,6 +20,7 @@
 Library for igus Dryve D1 motor controller
 """
 
+import logging
 import socket
 import struct
 import time
@@ -29,6 +30,17 @@ __copyright__ = "Copyright 2022 Mathis Reuß-Hennschen"
 __license__ = "GPL"
 __version__ = "1.0"
 
+LOGGER = logging.getLogger(__name__)
+
+# Convert between ints and the 4 little-endian data bytes used by the device.
+PACK_INT32 = struct.Struct("<i").pack
+UNPACK_INT32 = struct.Struct("<i").unpack_from
+
+# Fixed 19 byte Modbus TCP/MEI header (see make_bytearray), zero bytes padded.
+FRAME_HEADER = struct.Struct(">5xBxBBBxxBBBxxxB")
+# Value of the length byte for a frame without data bytes.
+FRAME_LENGTH = FRAME_HEADER.size - 6
+
 
 # =========================================================================== #
 # Example file structure:
@@ -43,7 +55,7 @@ __version__ = "1.0"
 # =========================================================================== #
 
 
-def make_bytearray(read_write, obj_ind, sub_ind, data_len, temp_data=[-1, -1, -1, -1]):
+def make_bytearray(read_write, obj_ind, sub_ind, data_len, temp_data=b""):
     """
     Create a bytearray which corresponds to an instruction set for the igus D1.
 
@@ -57,7 +69,7 @@ def make_bytearray(read_write, obj_ind, sub_ind, data_len, temp_data=[-1, -1, -1
         Sub-index for certain functions; if no subfunctions: 0
     data_len : int
         Amount of data bytes to send or receive.
-    temp_data : list[1 to 4], optional
+    temp_data : bytes[1 to 4], optional
         Data to send (only applicable if read_write == 1).
 
     Returns
@@ -79,24 +91,15 @@ def make_bytearray(read_write, obj_ind, sub_ind, data_len, temp_data=[-1, -1, -1
     #  bytes_amount,                            amount of data bytes to be sent/received
     #  data_1, data_2, data_3, data_4]          data bytes
 
-    data = []
-    for i in temp_data:
-        if i != -1:
-            data.append(i)
-
-    array = bytearray([0, 0,
-                       0, 0, 0,
-                       0,
-                       0, 43, 13,
-                       read_write,
-                       0, 0]
-                       + obj_ind +
-                       [sub_ind,
-                       0, 0, 0,
-                       data_len]
-                       + data)
-
-    array[5] = len(array) - 6
+    array = bytearray(FRAME_HEADER.size + len(temp_data))
+    FRAME_HEADER.pack_into(array, 0,
+                           FRAME_LENGTH + len(temp_data),
+                           43, 13,
+                           read_write,
+                           obj_ind[0], obj_ind[1],
+                           sub_ind,
+                           data_len)
+    array[FRAME_HEADER.size:] = temp_data
 
     return array
 
@@ -119,16 +122,54 @@ def get_array(selector):
     if selector == "status":
         sel = make_bytearray(0, [96, 65], 0, 2)
     elif selector == "shutdown":
-        sel = make_bytearray(1, [96, 64], 0, 2, [6, 0])
+        sel = make_bytearray(1, [96, 64], 0, 2, bytes([6, 0]))
     elif selector == "switch_on":
-        sel = make_bytearray(1, [96, 64], 0, 2, [7, 0])
+        sel = make_bytearray(1, [96, 64], 0, 2, bytes([7, 0]))
     elif selector == "enable_operation":
-        sel = make_bytearray(1, [96, 64], 0, 2, [15, 0])
+        sel = make_bytearray(1, [96, 64], 0, 2, bytes([15, 0]))
 
     return sel
 
+
+# Frames which never change are built once at import and reused while polling.
+STATUS_REQUEST = bytes(get_array("status"))
+SHUTDOWN_RESPONSES = (bytes(make_bytearray(0, [96, 65], 0, 2, bytes([33, 6]))),
+                      bytes(make_bytearray(0, [96, 65], 0, 2, bytes([33, 22]))),
+                      bytes(make_bytearray(0, [96, 65], 0, 2, bytes([33, 2]))))
+SWITCH_ON_RESPONSES = (bytes(make_bytearray(0, [96, 65], 0, 2, bytes([35, 6]))),
+                       bytes(make_bytearray(0, [96, 65], 0, 2, bytes([35, 22]))),
+                       bytes(make_bytearray(0, [96, 65], 0, 2, bytes([35, 2]))))
+ENABLE_OPERATION_RESPONSES = (bytes(make_bytearray(0, [96, 65], 0, 2, bytes([39, 6]))),
+                              bytes(make_bytearray(0, [96, 65], 0, 2, bytes([39, 22]))),
+                              bytes(make_bytearray(0, [96, 65], 0, 2, bytes([39, 2]))))
+HOMING_DONE_RESPONSE = ENABLE_OPERATION_RESPONSES[1]
+MOVE_DONE_RESPONSE = ENABLE_OPERATION_RESPONSES[0]
+
+# Pause between two status requests while waiting for a state change. The
+# reply itself is awaited by the blocking recv, so this only paces the polling.
+POLL_INTERVAL = 0.05
+
+# Seconds to wait for an answer before the device is considered to have
+# skipped it, and how often a status request is sent before giving up.
+TIMEOUT = 0.5
+POLL_RETRIES = 3
+
 SOCK = 0
 
+# (IP, port) of the device, kept for reconnecting (see reconnect).
+ADDRESS = None
+
+# Transaction ID of the last pipelined command (see send_commands).
+TRANSACTION_ID = 0
+
+# Mode last confirmed by the device, None if unknown (see set_mode).
+MODE = None
+
+# Responses are received into this buffer (a Modbus TCP frame has at most
+# 260 bytes) and only copied out once complete.
+RX_BUFFER = bytearray(260)
+RX_VIEW = memoryview(RX_BUFFER)
+
 def init_socket(ip_address,
                 port=502):
     """
@@ -146,22 +187,44 @@ def init_socket(ip_address,
     None.
 
     """
-    global SOCK
+    global SOCK, MODE, ADDRESS
+
+    MODE = None
+    ADDRESS = (ip_address, port)
 
     try:
         SOCK = socket.socket(socket.AF_INET,
                                   socket.SOCK_STREAM)
+        # send every small frame immediately instead of waiting for ACKs
+        SOCK.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # detect a controller which went away without closing the connection
+        SOCK.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 
     except:
         pass
 
     try:
         SOCK.connect((ip_address, port))
+        SOCK.settimeout(TIMEOUT)
 
     except:
         pass
 
 
+def reconnect():
+    """
+    Close the socket and connect to the last device again, which drops any
+    answers still underway.
+
+    Returns
+    -------
+    None.
+
+    """
+    SOCK.close()
+    init_socket(*ADDRESS)
+
+
 def send_command(data):
     """
     Send a command to the device.
@@ -176,11 +239,145 @@ def send_command(data):
     bytes
         Returned data as a bytes object.
 
+    Raises
+    ------
+    socket.timeout
+        If the device does not answer within TIMEOUT (the connection is
+        reset before raising).
+
+    """
+    try:
+        SOCK.sendall(data)
+
+        return receive_response()
+
+    except socket.timeout:
+        reconnect()
+        raise
+
+
+def poll(request):
+    """
+    Send a polling request, sending it again if the device skips an answer.
+
+    Parameters
+    ----------
+    request : bytes
+        Request to send to the device.
+
+    Returns
+    -------
+    bytes
+        Returned data as a bytes object.
+
+    """
+    for _ in range(POLL_RETRIES - 1):
+        try:
+            return send_command(request)
+
+        except socket.timeout:
+            LOGGER.warning("No answer from the device, sending request again")
+
+    return send_command(request)
+
+
+def receive_into(start, stop):
     """
-    SOCK.send(data)
-    res = SOCK.recv(24)
+    Fill RX_BUFFER[start:stop] with bytes from the device.
 
-    return res
+    Parameters
+    ----------
+    start : int
+        First buffer index to fill.
+    stop : int
+        Buffer index to stop at.
+
+    Returns
+    -------
+    None.
+
+    """
+    while start < stop:
+        received = SOCK.recv_into(RX_VIEW[start:stop])
+        if not received:
+            raise ConnectionError("Connection closed by the device")
+        start += received
+
+
+def receive_response():
+    """
+    Receive one complete response frame, using the length field of its header.
+
+    Returns
+    -------
+    bytes
+        Returned data as a bytes object.
+
+    """
+    receive_into(0, 6)
+    size = 6 + (RX_BUFFER[4] << 8 | RX_BUFFER[5])
+    if size > len(RX_BUFFER):
+        raise ValueError("Invalid response length: " + str(size))
+    receive_into(6, size)
+
+    return bytes(RX_VIEW[:size])
+
+
+def send_commands(frames):
+    """
+    Send several commands back to back, then collect their responses.
+
+    This costs one round trip instead of one per command. Every frame is
+    sent with its own transaction ID, which is used to match the responses
+    to their commands.
+
+    Parameters
+    ----------
+    frames : list[bytearray]
+        Bytearrays to send to the device.
+
+    Returns
+    -------
+    list[bytes]
+        Returned data for each command, in the order they were sent.
+
+    Raises
+    ------
+    socket.timeout
+        If the device does not answer within TIMEOUT (the connection is
+        reset before raising).
+
+    """
+    global TRANSACTION_ID
+
+    pending = {}
+    responses = [None] * len(frames)
+    try:
+        # collect all frames first so they leave in as few segments as possible
+        buffer = bytearray()
+        for index, frame in enumerate(frames):
+            # IDs run from 1 to 65535, 0 is left to send_command
+            TRANSACTION_ID = TRANSACTION_ID % 0xFFFF + 1
+            start = len(buffer)
+            buffer += frame
+            buffer[start] = TRANSACTION_ID >> 8
+            buffer[start + 1] = TRANSACTION_ID & 0xFF
+            pending[TRANSACTION_ID] = index
+        SOCK.sendall(buffer)
+
+        while pending:
+            response = receive_response()
+            index = pending.pop(response[0] << 8 | response[1], None)
+            if index is None:
+                LOGGER.debug("Discarding unexpected response: %s", response.hex())
+                continue
+            responses[index] = response
+
+    except socket.timeout:
+        reconnect()
+        raise
+
+    return responses
 
 
 def set_shutdown():
@@ -194,20 +391,9 @@ def set_shutdown():
     """
     send_command(get_array("shutdown"))
 
-    ba_1 = make_bytearray(0, [96, 65], 0, 2, [33, 6])
-    ba_2 = make_bytearray(0, [96, 65], 0, 2, [33, 22])
-    ba_3 = make_bytearray(0, [96, 65], 0, 2, [33, 2])
-
-    while (send_command(get_array("status")) !=
-           ba_1
-           and
-           send_command(get_array("status")) !=
-           ba_2
-           and
-           send_command(get_array("status")) !=
-           ba_3):
-        print('Waiting for shutdown...')
-        time.sleep(1)
+    while poll(STATUS_REQUEST) not in SHUTDOWN_RESPONSES:
+        LOGGER.debug("Waiting for shutdown...")
+        time.sleep(POLL_INTERVAL)
 
 
 def set_switch_on():
@@ -221,16 +407,9 @@ def set_switch_on():
     """
     send_command(get_array("switch_on"))
 
-    while (send_command(get_array("status")) !=
-           make_bytearray(0, [96, 65], 0, 2, [35, 6])
-           and
-           send_command(get_array("status")) !=
-           make_bytearray(0, [96, 65], 0, 2, [35, 22])
-           and
-           send_command(get_array("status")) !=
-           make_bytearray(0, [96, 65], 0, 2, [35, 2])):
-        print('Waiting for switch-on...')
-        time.sleep(1)
+    while poll(STATUS_REQUEST) not in SWITCH_ON_RESPONSES:
+        LOGGER.debug("Waiting for switch-on...")
+        time.sleep(POLL_INTERVAL)
 
 
 def set_enable_operation():
@@ -244,16 +423,9 @@ def set_enable_operation():
     """
     send_command(get_array("enable_operation"))
 
-    while (send_command(get_array("status")) !=
-           make_bytearray(0, [96, 65], 0, 2, [39, 6])
-           and
-           send_command(get_array("status")) !=
-           make_bytearray(0, [96, 65], 0, 2, [39, 22])
-           and
-           send_command(get_array("status")) !=
-           make_bytearray(0, [96, 65], 0, 2, [39, 2])):
-        print('Waiting for enabling operation...')
-        time.sleep(1)
+    while poll(STATUS_REQUEST) not in ENABLE_OPERATION_RESPONSES:
+        LOGGER.debug("Waiting for enabling operation...")
+        time.sleep(POLL_INTERVAL)
 
 
 def init():
@@ -284,17 +456,14 @@ def set_feedrate(feedrate):
     None.
 
     """
-    feedrate_bytes = feedrate.to_bytes(4, "little")
-
-    send_command(make_bytearray(1, [96, 146], 1, 2, [feedrate_bytes[0],
-                                                          feedrate_bytes[1]]))
-
-    send_command(make_bytearray(1, [96, 146], 2, 1, [1]))
+    send_commands([make_bytearray(1, [96, 146], 1, 2, PACK_INT32(feedrate)[:2]),
+                   make_bytearray(1, [96, 146], 2, 1, bytes([1]))])
 
 
 def set_mode(mode):
     """
-    Set the movement mode of the device.
+    Set the movement mode of the device (skipped if the mode was already
+    set on this connection).
 
     Parameters
     ----------
@@ -306,13 +475,19 @@ def set_mode(mode):
     None.
 
     """
-    send_command(make_bytearray(1, [96, 96], 0, 1, [mode]))
+    global MODE
 
-    while (send_command(make_bytearray(0, [96, 97], 0, 1))
-           !=
-           make_bytearray(0, [96, 97], 0, 1, [mode])):
+    if mode == MODE:
+        return
+
+    send_command(make_bytearray(1, [96, 96], 0, 1, bytes([mode])))
 
-        time.sleep(1)
+    mode_request = make_bytearray(0, [96, 97], 0, 1)
+    mode_response = make_bytearray(0, [96, 97], 0, 1, bytes([mode]))
+    while poll(mode_request) != mode_response:
+        time.sleep(POLL_INTERVAL)
+
+    MODE = mode
 
 
 def set_homing(method, find_velocity, zero_velocity, acceleration):
@@ -347,38 +522,32 @@ def set_homing(method, find_velocity, zero_velocity, acceleration):
 
     selected_method = methods[method]
 
-    # homing method
-    send_command(make_bytearray(1, [96, 152], 1, 1, [selected_method]))
-
     set_feedrate(6000)
 
-    # homing velocity – max search velocity
-    find_velocity_bytes = find_velocity.to_bytes(4, "little")
-    send_command(make_bytearray(1, [96, 153], 1, 2, [find_velocity_bytes[0],
-                                                          find_velocity_bytes[1]]))
-
-    # zeroing velocity – velocity after contact
-    zero_velocity_bytes = zero_velocity.to_bytes(4, "little")
-    send_command(make_bytearray(1, [96, 153], 2, 2, [zero_velocity_bytes[0],
-                                                          zero_velocity_bytes[1]]))
-
-    # homing acceleration
-    acceleration_bytes = acceleration.to_bytes(4, "little")
-    send_command(make_bytearray(1, [96, 154], 0, 2, [acceleration_bytes[0],
-                                                          acceleration_bytes[1]]))
+    send_commands([
+        # homing method
+        make_bytearray(1, [96, 152], 1, 1, bytes([selected_method])),
+        # homing velocity – max search velocity
+        make_bytearray(1, [96, 153], 1, 2, PACK_INT32(find_velocity)[:2]),
+        # zeroing velocity – velocity after contact
+        make_bytearray(1, [96, 153], 2, 2, PACK_INT32(zero_velocity)[:2]),
+        # homing acceleration
+        make_bytearray(1, [96, 154], 0, 2, PACK_INT32(acceleration)[:2])])
 
     # start movement
-    print(list(send_command(make_bytearray(1, [96, 64], 0, 2, [31, 0]))))
+    response = send_command(make_bytearray(1, [96, 64], 0, 2, bytes([31, 0])))
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("Start response: %s", response.hex())
 
     # reset start bit
-    send_command(make_bytearray(1, [96, 64], 0, 2, [15, 0]))
+    send_command(make_bytearray(1, [96, 64], 0, 2, bytes([15, 0])))
 
-    while (send_command(get_array("status"))
-           !=
-           make_bytearray(0, [96, 65], 0, 2, [39, 22])):
-        print("wait for Homing to end")
-        print(list(send_command(get_array("status"))))
-        time.sleep(1)
+    response = poll(STATUS_REQUEST)
+    while response != HOMING_DONE_RESPONSE:
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("Waiting for homing to end, status: %s", response.hex())
+        time.sleep(POLL_INTERVAL)
+        response = poll(STATUS_REQUEST)
 
     send_command(get_array("enable_operation"))
 
@@ -405,39 +574,80 @@ def move(velocity,
     """
     set_mode(1)
 
-    velocity_bytes = velocity.to_bytes(4, "little")
-    send_command(make_bytearray(1, [96, 129], 0, 4, [velocity_bytes[0],
-                                                          velocity_bytes[1],
-                                                          velocity_bytes[2],
-                                                          velocity_bytes[3]]))
+    send_commands([make_bytearray(1, [96, 129], 0, 4, PACK_INT32(velocity)),
+                   make_bytearray(1, [96, 131], 0, 4, PACK_INT32(acceleration)),
+                   make_bytearray(1, [96, 122], 0, 4, PACK_INT32(target_position))])
+
+    start_movement()
 
-    acceleration_bytes = acceleration.to_bytes(4, "little")
-    send_command(make_bytearray(1, [96, 131], 0, 4, [acceleration_bytes[0],
-                                                          acceleration_bytes[1],
-                                                          acceleration_bytes[2],
-                                                          acceleration_bytes[3]]))
 
-    target_position_bytes = target_position.to_bytes(4, "little")
-    send_command(make_bytearray(1, [96, 122], 0, 4, [target_position_bytes[0],
-                                                          target_position_bytes[1],
-                                                          target_position_bytes[2],
-                                                          target_position_bytes[3]]))
+def set_motion_parameters(velocity, acceleration):
+    """
+    Set velocity and acceleration for the following moves.
+
+    Parameters
+    ----------
+    velocity : int
+        Velocity when moving.
+    acceleration : int
+        Acceleration/deceleration when starting/stopping move.
 
-    print(list(send_command(make_bytearray(1, [96, 64], 0, 2, [31, 0]))))
+    Returns
+    -------
+    None.
 
-    send_command(make_bytearray(1, [96, 64], 0, 2, [15, 0]))
+    """
+    send_commands([make_bytearray(1, [96, 129], 0, 4, PACK_INT32(velocity)),
+                   make_bytearray(1, [96, 131], 0, 4, PACK_INT32(acceleration))])
 
-    while (send_command(get_array("status"))
+
+def move_to_position(target_position):
+    """
+    Move the sled to a position using the current velocity and acceleration
+    (requires mode 1, see set_mode and set_motion_parameters).
+
+    Parameters
+    ----------
+    target_position : int
+        Target position in steps.
+
+    Returns
+    -------
+    None.
+
+    """
+    send_command(make_bytearray(1, [96, 122], 0, 4, PACK_INT32(target_position)))
+
+    start_movement()
+
+
+def start_movement():
+    """
+    Start moving to the target position written last and wait until it is
+    reached.
+
+    Returns
+    -------
+    None.
+
+    """
+    response = send_command(make_bytearray(1, [96, 64], 0, 2, bytes([31, 0])))
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("Start response: %s", response.hex())
+
+    send_command(make_bytearray(1, [96, 64], 0, 2, bytes([15, 0])))
+
+    while (poll(STATUS_REQUEST)
            !=
-           make_bytearray(0, [96, 65], 0, 2, [39, 6])):
+           MOVE_DONE_RESPONSE):
+
+        time.sleep(POLL_INTERVAL)
+
+    # reading back position and velocity costs two round trips, only do it
+    # if someone is going to see it
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("Movement done, position and velocity: %s", get_status())
 
-        time.sleep(0.1)
-    status = []
-    actual_position_bytes = send_command(make_bytearray(0, [96, 100], 0, 4))
-    status.append(struct.unpack("<xxxxxxxxxxxxxxxxxxxi", actual_position_bytes)[0])
-    actual_velocity_bytes = send_command(make_bytearray(0, [96, 108], 0, 4))
-    status.append(struct.unpack("<xxxxxxxxxxxxxxxxxxxi", actual_velocity_bytes)[0])
-    print(status)
     send_command(get_array("enable_operation"))
 
 
@@ -477,26 +687,18 @@ def staggered_move(velocity,
     """
     set_mode(1)
 
-    velocity_bytes = velocity.to_bytes(4, "little")
-    send_command(make_bytearray(1, [96, 129], 0, 4, [velocity_bytes[0],
-                                                          velocity_bytes[1],
-                                                          velocity_bytes[2],
-                                                          velocity_bytes[3]]))
+    set_motion_parameters(velocity, acceleration)
 
-    acceleration_bytes = acceleration.to_bytes(4, "little")
-    send_command(make_bytearray(1, [96, 131], 0, 4, [acceleration_bytes[0],
-                                                          acceleration_bytes[1],
-                                                          acceleration_bytes[2],
-                                                          acceleration_bytes[3]]))
+    move_to_position(start_position)
 
-    move(velocity, acceleration, start_position)
-
-    for i in range(iterations):
-        move(velocity, acceleration, start_position + step_width * (i + 1))
+    target_position = start_position
+    for _ in range(iterations):
+        target_position += step_width
+        move_to_position(target_position)
         time.sleep(wait_time)
 
     if go_back is True:
-        move(velocity, acceleration, start_position)
+        move_to_position(start_position)
 
 
 def get_status():
@@ -512,10 +714,10 @@ def get_status():
     status = []
 
     actual_position_bytes = send_command(make_bytearray(0, [96, 100], 0, 4))
-    status.append(struct.unpack("<xxxxxxxxxxxxxxxxxxxi", actual_position_bytes)[0])
+    status.append(UNPACK_INT32(actual_position_bytes, FRAME_HEADER.size)[0])
 
     actual_velocity_bytes = send_command(make_bytearray(0, [96, 108], 0, 4))
-    status.append(struct.unpack("<xxxxxxxxxxxxxxxxxxxi", actual_velocity_bytes)[0])
+    status.append(UNPACK_INT32(actual_velocity_bytes, FRAME_HEADER.size)[0])
 
     return status
 
@@ -528,4 +730,7 @@ def close():
     None.
 
     """
+    global MODE
+
+    MODE = None
     SOCK.close()